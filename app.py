@@ -1,20 +1,60 @@
-import io
+import atexit
 import re
+import shutil
+import tempfile
+import time
 import zipfile
 import hashlib
+import itertools
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO
 from urllib.parse import urljoin, urlparse
 
-import requests
+import httpx
+import lxml.html
 import streamlit as st
-from bs4 import BeautifulSoup
+from lxml import etree
 
 
 # ----------------------------
 # Helpers
 # ----------------------------
 
-IMG_EXTS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff", ".svg", ".avif"}
+MAX_WORKERS = 16  # concurrent image downloads
+# Downloads allowed ahead of the zip writer; bounds how many payloads sit in RAM
+MAX_IN_FLIGHT = 2 * MAX_WORKERS
+RETRIES = 2  # extra attempts for transport errors and RETRY_STATUSES
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+RETRY_BACKOFF_S = 0.2
+RETRY_AFTER_STATUSES = frozenset({429, 503})  # where a Retry-After header is honoured
+MAX_IMAGE_BYTES = 50 * 1024 * 1024  # skip anything bigger than this
+CHUNK_SIZE = 64 * 1024
+CACHE_TTL_S = 300
+# Level 1 keeps deflate cheap for the odd SVG/BMP; the default level 6 burns
+# CPU for little extra win. Already-compressed formats skip deflate entirely.
+ZIP_COMPRESSLEVEL = 1
+# A tuple so it can be handed straight to str.endswith, which does the whole
+# check in C (measurably faster than a single anchored regex search)
+IMG_EXTS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff", ".svg", ".avif")
+# Formats that are compressed already; deflating them only costs CPU
+PRECOMPRESSED_EXTS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif")
+_CT_EXT_MAP = {
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/avif": ".avif",
+    "image/svg+xml": ".svg",
+    "image/bmp": ".bmp",
+    "image/tiff": ".tiff",
+}
+_HTML_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+_UNSAFE_CHARS_RE = re.compile(r"[^\w\-. ]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+_SRCSET_DESCRIPTOR_RE = re.compile(r"(\d+)(w|x)$")
 DEFAULT_HEADERS = {
     "User-Agent": (
         "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
@@ -31,10 +71,34 @@ class DownloadResult:
     content_type: str
 
 
+class NoImagesDownloaded(Exception):
+    """
+    Raised instead of returning an empty result, so st.cache_data doesn't
+    keep a run where every image failed and the next click retries it.
+    """
+
+    def __init__(self, skipped: list[str]):
+        super().__init__(f"no images downloaded ({len(skipped)} skipped/failed)")
+        self.skipped = skipped
+
+
+@dataclass
+class ZipEntry:
+    """
+    A downloaded image ready to append to the zip. The dedup digest and the
+    storage method are worked out in the worker thread.
+    """
+    filename: str  # before unique_name() de-duplication; the extension is final
+    content_type: str
+    digest: bytes
+    compress_type: int
+    data: bytes
+
+
 def safe_filename(name: str, fallback: str = "image") -> str:
     name = name.strip()
-    name = re.sub(r"[^\w\-. ]+", "_", name)
-    name = re.sub(r"\s+", "_", name)
+    name = _UNSAFE_CHARS_RE.sub("_", name)
+    name = _WHITESPACE_RE.sub("_", name)
     if not name:
         name = fallback
     # keep it reasonable
@@ -42,19 +106,11 @@ def safe_filename(name: str, fallback: str = "image") -> str:
 
 
 def guess_ext_from_content_type(ct: str) -> str:
-    ct = (ct or "").lower().split(";")[0].strip()
-    mapping = {
-        "image/jpeg": ".jpg",
-        "image/jpg": ".jpg",
-        "image/png": ".png",
-        "image/gif": ".gif",
-        "image/webp": ".webp",
-        "image/avif": ".avif",
-        "image/svg+xml": ".svg",
-        "image/bmp": ".bmp",
-        "image/tiff": ".tiff",
-    }
-    return mapping.get(ct, "")
+    ct = ct or ""
+    i = ct.find(";")
+    if i >= 0:
+        ct = ct[:i]
+    return _CT_EXT_MAP.get(ct.strip().lower(), "")
 
 
 def pick_best_from_srcset(srcset: str) -> str | None:
@@ -75,7 +131,7 @@ def pick_best_from_srcset(srcset: str) -> str | None:
         url = bits[0].strip()
         w = 0
         if len(bits) > 1:
-            m = re.match(r"(\d+)(w|x)$", bits[1].strip())
+            m = _SRCSET_DESCRIPTOR_RE.match(bits[1].strip())
             if m:
                 w = int(m.group(1))
         candidates.append((w, url))
@@ -88,18 +144,26 @@ def pick_best_from_srcset(srcset: str) -> str | None:
 
 def is_probably_image_url(u: str) -> bool:
     path = urlparse(u).path.lower()
-    for ext in IMG_EXTS:
-        if path.endswith(ext):
-            return True
+    if path.endswith(IMG_EXTS):
+        return True
     # sometimes no extension but still image via content-type, allow it later
     return False
 
 
 def extract_image_urls(html: str, base_url: str) -> list[str]:
-    soup = BeautifulSoup(html, "lxml")
-    urls: set[str] = set()
-
-    for img in soup.find_all("img"):
+    if not html.strip():
+        return []
+    try:
+        # Parse from UTF-8 bytes: lxml refuses str input that carries an
+        # XML encoding declaration.
+        tree = lxml.html.fromstring(html.encode("utf-8"), parser=_HTML_PARSER)
+    except etree.ParserError:
+        return []
+
+    # dict for ordered de-duplication: keeps page (DOM) order
+    urls: dict[str, None] = {}
+
+    for img in tree.iter("img"):
         # Try srcset first (often has best quality)
         srcset = img.get("srcset")
         best = pick_best_from_srcset(srcset) if srcset else None
@@ -117,13 +181,16 @@ def extract_image_urls(html: str, base_url: str) -> list[str]:
             continue
 
         abs_url = urljoin(base_url, src)
-        urls.add(abs_url)
+        urls[abs_url] = None
 
-    # Keep stable order-ish
-    return sorted(urls)
+    return list(urls)
 
 
-def unique_name(existing: set[str], proposed: str) -> str:
+def unique_name(existing: set[str], proposed: str, counters: dict[str, int]) -> str:
+    """
+    counters remembers the last suffix handed out per proposed name, so a
+    page full of "thumbnail.jpg" doesn't re-probe _2, _3, ... every time.
+    """
     if proposed not in existing:
         existing.add(proposed)
         return proposed
@@ -131,90 +198,281 @@ def unique_name(existing: set[str], proposed: str) -> str:
     stem, dot, ext = proposed.rpartition(".")
     if not dot:  # no ext
         stem, ext = proposed, ""
-    for i in range(2, 10_000):
+    start = counters.get(proposed, 1) + 1
+    for i in range(start, start + 10_000):
         candidate = f"{stem}_{i}{('.' + ext) if ext else ''}"
         if candidate not in existing:
+            counters[proposed] = i
             existing.add(candidate)
             return candidate
     # last resort
-    h = hashlib.sha256(proposed.encode("utf-8")).hexdigest()[:10]
+    h = hashlib.blake2b(proposed.encode("utf-8"), digest_size=5).hexdigest()
     candidate = f"{stem}_{h}{('.' + ext) if ext else ''}"
     existing.add(candidate)
     return candidate
 
 
-def build_zip_from_images(page_url: str, timeout_s: int = 25, max_images: int = 300) -> tuple[bytes, list[DownloadResult], list[str]]:
+def make_zip_info(filename: str, compress_type: int) -> zipfile.ZipInfo:
+    zi = zipfile.ZipInfo(filename, date_time=time.localtime()[:6])
+    zi.external_attr = 0o600 << 16  # same default permissions as ZipFile.writestr
+    zi.compress_type = compress_type
+    return zi
+
+
+def make_client() -> httpx.Client:
+    """
+    HTTP/2 client shared by all download threads. Against an HTTP/2 CDN every
+    image is multiplexed over one TLS connection; HTTP/1.1 hosts get a
+    keep-alive pool big enough for MAX_WORKERS.
+    """
+    transport = httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    )  # no transport-level retries: those only cover connect errors, see send_with_retries
+    return httpx.Client(transport=transport, headers=DEFAULT_HEADERS, follow_redirects=True)
+
+
+def send_with_retries(client: httpx.Client, url: str, timeout_s: int, stream: bool = False) -> httpx.Response:
     """
-    Returns (zip_bytes, downloaded_results, skipped_urls)
+    GET url, retrying transport errors (connect/read timeouts, connections
+    dropped before the response arrives) and RETRY_STATUSES with
+    exponential backoff. A numeric Retry-After on 429/503 is waited out
+    instead, capped at timeout_s. The final response is returned whatever
+    its status; callers raise_for_status(). With stream=True the caller
+    must close() the response.
     """
-    sess = requests.Session()
-    sess.headers.update(DEFAULT_HEADERS)
+    attempt = 0
+    while True:
+        delay = RETRY_BACKOFF_S * 2**attempt
+        request = client.build_request("GET", url, timeout=timeout_s)
+        try:
+            r = client.send(request, stream=stream)
+        except httpx.TransportError:
+            if attempt >= RETRIES:
+                raise
+        else:
+            if r.status_code not in RETRY_STATUSES or attempt >= RETRIES:
+                return r
+            retry_after = r.headers.get("Retry-After", "").strip()
+            if r.status_code in RETRY_AFTER_STATUSES and retry_after.isdigit():
+                delay = min(int(retry_after), timeout_s)
+            r.close()
+        time.sleep(delay)
+        attempt += 1
+
+
+def fetch_image(client: httpx.Client, img_url: str, timeout_s: int) -> tuple[str, bytes] | None:
+    """
+    Download a single image. Returns (content_type, raw_bytes), or None if
+    the response isn't an image or is bigger than MAX_IMAGE_BYTES.
+    Runs in a worker thread.
+
+    The streamed GET doubles as the probe: headers are checked before any of
+    the body is read, so rejected responses cost one round trip, same as a
+    HEAD would, without a second request for the ones we keep.
+    """
+    r = send_with_retries(client, img_url, timeout_s, stream=True)
+    try:
+        r.raise_for_status()
+
+        # Decide from the headers before pulling any of the body
+        ct = (r.headers.get("Content-Type") or "").lower()
+        if not ct.startswith("image/"):
+            # Some sites return HTML for blocked assets
+            return None
+
+        length = r.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > MAX_IMAGE_BYTES:
+            return None
+
+        buf = bytearray()
+        for chunk in r.iter_bytes(CHUNK_SIZE):
+            buf.extend(chunk)
+            if len(buf) > MAX_IMAGE_BYTES:
+                # Server lied about (or omitted) the size; don't keep a truncated image
+                return None
+    finally:
+        r.close()
 
-    # Fetch page
-    resp = sess.get(page_url, timeout=timeout_s, allow_redirects=True)
-    resp.raise_for_status()
+    return ct, bytes(buf)
 
-    base_url = resp.url  # final URL after redirects
-    image_urls = extract_image_urls(resp.text, base_url)
 
-    if not image_urls:
-        return b"", [], []
+def prepare_entry(client: httpx.Client, img_url: str, idx: int, timeout_s: int) -> ZipEntry | None:
+    """
+    Download one image, name it and hash it, off the main thread.
+    Returns None if there's nothing worth zipping.
+    """
+    fetched = fetch_image(client, img_url, timeout_s)
+    if fetched is None:
+        return None
+
+    ct, raw = fetched
+    if not raw:
+        return None
+
+    # Determine filename
+    path_name = urlparse(img_url).path.rsplit("/", 1)[-1]
+    path_name = safe_filename(path_name or f"image_{idx}")
+
+    # If path already has known ext, keep it. Else use content-type.
+    if path_name.lower().endswith(IMG_EXTS):
+        filename = path_name
+    else:
+        ext = guess_ext_from_content_type(ct) or ".img"
+        filename = f"{path_name}{ext}"
+
+    # Already-compressed formats are stored as-is; SVG, BMP, TIFF and unknown
+    # types are deflated
+    if filename.lower().endswith(PRECOMPRESSED_EXTS):
+        compress_type = zipfile.ZIP_STORED
+    else:
+        compress_type = zipfile.ZIP_DEFLATED
+
+    return ZipEntry(
+        filename=filename,
+        content_type=ct.split(";")[0],
+        digest=hashlib.blake2b(raw, digest_size=8).digest(),
+        compress_type=compress_type,
+        data=raw,
+    )
 
-    image_urls = image_urls[:max_images]
 
-    zip_buffer = io.BytesIO()
-    downloaded: list[DownloadResult] = []
-    skipped: list[str] = []
+def zip_images(
+    client: httpx.Client, image_urls: list[str], timeout_s: int, out: BinaryIO
+) -> tuple[list[DownloadResult], list[str]]:
+    """
+    Download image_urls and write them as a zip into out (seekable).
+    Returns (downloaded_results, skipped_urls)
+    """
+    # Tagged with the page index so both lists come back in page order
+    downloaded: list[tuple[int, DownloadResult]] = []
+    skipped: list[tuple[int, str]] = []
 
     used_names: set[str] = set()
+    name_counters: dict[str, int] = {}
+    # Same logo/sprite/avatar served under several URLs only goes in once
+    seen_digests: set[bytes] = set()
+
+    # Downloads run concurrently; the zip is only ever touched from this thread
+    # (ZipFile isn't thread-safe). Entries are written as downloads complete, so
+    # a slow image never holds up the rest. At most MAX_IN_FLIGHT downloads are
+    # outstanding: the queue is topped up as each one lands, and each payload
+    # is dropped once written, so only that many are ever held in memory.
+    # Collision suffixes (_2, _3, ...) follow completion order; the returned
+    # lists are in page order.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        jobs = enumerate(image_urls, start=1)
+        running: dict[Future[ZipEntry | None], tuple[int, str]] = {}
+
+        def top_up() -> None:
+            for idx, img_url in itertools.islice(jobs, MAX_IN_FLIGHT - len(running)):
+                running[pool.submit(prepare_entry, client, img_url, idx, timeout_s)] = (idx, img_url)
+
+        top_up()
+        with zipfile.ZipFile(out, mode="w") as zf:
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                while done:
+                    future = done.pop()
+                    idx, img_url = running.pop(future)
+                    top_up()
+
+                    try:
+                        entry = future.result()
+                        if entry is None:
+                            skipped.append((idx, img_url))
+                            continue
+
+                        if entry.digest in seen_digests:
+                            skipped.append((idx, img_url))
+                            continue
+                        seen_digests.add(entry.digest)
+
+                        filename = unique_name(used_names, entry.filename, name_counters)
+                        zf.writestr(
+                            make_zip_info(filename, entry.compress_type), entry.data, compresslevel=ZIP_COMPRESSLEVEL
+                        )
+
+                        downloaded.append(
+                            (
+                                idx,
+                                DownloadResult(
+                                    url=img_url,
+                                    filename=filename,
+                                    size_bytes=len(entry.data),
+                                    content_type=entry.content_type,
+                                ),
+                            )
+                        )
+                    except Exception:
+                        skipped.append((idx, img_url))
+                    finally:
+                        future = entry = None  # release the payload before handling the next one
+
+    downloaded.sort(key=lambda t: t[0])
+    skipped.sort(key=lambda t: t[0])
+    return [d for _, d in downloaded], [u for _, u in skipped]
+
+
+@st.cache_resource
+def zip_dir() -> Path:
+    """
+    Folder the zips are built in. mkdtemp() makes it private (0700) and
+    unguessable, so other local users can't swap or delete archives; cached
+    so script reruns reuse one folder per process. Removed at exit.
+    """
+    path = Path(tempfile.mkdtemp(prefix="grabapic-"))
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    return path
+
+
+def prune_old_zips(directory: Path, max_age_s: float) -> None:
+    cutoff = time.time() - max_age_s
+    for path in directory.glob("*.zip"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass  # another session got to it first
 
-    with zipfile.ZipFile(zip_buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for idx, img_url in enumerate(image_urls, start=1):
-            try:
-                r = sess.get(img_url, timeout=timeout_s, stream=True, allow_redirects=True)
-                r.raise_for_status()
-
-                ct = (r.headers.get("Content-Type") or "").lower()
-                if not ct.startswith("image/"):
-                    # Some sites return HTML for blocked assets
-                    skipped.append(img_url)
-                    continue
-
-                raw = r.content
-                if not raw:
-                    skipped.append(img_url)
-                    continue
-
-                # Determine filename
-                path_name = urlparse(img_url).path.split("/")[-1]
-                path_name = safe_filename(path_name or f"image_{idx}")
-
-                ext = ""
-                # If path already has known ext, keep it. Else use content-type.
-                lower_path = path_name.lower()
-                if any(lower_path.endswith(e) for e in IMG_EXTS):
-                    filename = path_name
-                else:
-                    ext = guess_ext_from_content_type(ct) or ".img"
-                    filename = f"{path_name}{ext}"
-
-                filename = unique_name(used_names, filename)
-
-                zf.writestr(filename, raw)
-
-                downloaded.append(
-                    DownloadResult(
-                        url=img_url,
-                        filename=filename,
-                        size_bytes=len(raw),
-                        content_type=ct.split(";")[0],
-                    )
-                )
-            except Exception:
-                skipped.append(img_url)
-
-    zip_buffer.seek(0)
-    return zip_buffer.getvalue(), downloaded, skipped
+
+@st.cache_data(ttl=CACHE_TTL_S, max_entries=8, show_spinner=False)
+def build_zip_from_images(page_url: str, timeout_s: int = 25, max_images: int = 300) -> tuple[str, list[DownloadResult], list[str]]:
+    """
+    Returns (zip_path, downloaded_results, skipped_urls). Raises
+    NoImagesDownloaded if nothing ended up in the zip.
+
+    The zip is written straight to a file under zip_dir() and only its path is
+    pickled into the cache. While building, memory is bounded by the
+    MAX_IN_FLIGHT payloads zip_images keeps queued; the finished archive is
+    first loaded whole when the download button reads it. Zip files whose
+    cache entry expired or was evicted stay on disk until a later build
+    prunes them (older than two TTLs).
+
+    Cached for a few minutes per (page_url, timeout_s, max_images), so
+    clicking Fetch again or any other rerun doesn't re-download everything.
+    """
+    with make_client() as client:
+        # Fetch page
+        resp = send_with_retries(client, page_url, timeout_s)
+        resp.raise_for_status()
+
+        base_url = str(resp.url)  # final URL after redirects
+        image_urls = extract_image_urls(resp.text, base_url)
+
+        if not image_urls:
+            raise NoImagesDownloaded([])
+
+        directory = zip_dir()
+        # Anything this old can't be referenced by a live cache entry anymore
+        prune_old_zips(directory, 2 * CACHE_TTL_S)
+
+        with tempfile.NamedTemporaryFile(dir=directory, suffix=".zip", delete=False) as out:
+            downloaded, skipped = zip_images(client, image_urls[:max_images], timeout_s, out)
+        if not downloaded:
+            Path(out.name).unlink(missing_ok=True)
+            raise NoImagesDownloaded(skipped)
+        return out.name, downloaded, skipped
 
 
 # ----------------------------
@@ -243,25 +501,24 @@ if go:
 
     with st.spinner("Fetching page and downloading images..."):
         try:
-            zip_bytes, downloaded, skipped = build_zip_from_images(
+            zip_path, downloaded, skipped = build_zip_from_images(
                 url, timeout_s=int(timeout_s), max_images=int(max_images)
             )
-        except requests.HTTPError as e:
+        except NoImagesDownloaded as e:
+            st.warning("No downloadable images found (or the site blocked access).")
+            if e.skipped:
+                st.caption(f"Skipped/failed: {len(e.skipped)}")
+            st.stop()
+        except httpx.HTTPStatusError as e:
             st.error(f"HTTP error: {e}")
             st.stop()
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             st.error(f"Network error: {e}")
             st.stop()
         except Exception as e:
             st.error(f"Unexpected error: {e}")
             st.stop()
 
-    if not downloaded:
-        st.warning("No downloadable images found (or the site blocked access).")
-        if skipped:
-            st.caption(f"Skipped/failed: {len(skipped)}")
-        st.stop()
-
     parsed = urlparse(url)
     base = safe_filename(parsed.netloc or "images")
     zip_name = f"{base}_images.zip"
@@ -269,13 +526,22 @@ if go:
     total_bytes = sum(d.size_bytes for d in downloaded)
     st.success(f"Downloaded {len(downloaded)} images, zipped size depends on compression (raw total: {total_bytes:,} bytes).")
 
-    st.download_button(
-        label="⬇️ Download ZIP now",
-        data=zip_bytes,
-        file_name=zip_name,
-        mime="application/zip",
-        use_container_width=True,
-    )
+    try:
+        zip_file = open(zip_path, "rb")
+    except FileNotFoundError:
+        # Cleaned out of the temp dir behind the cache's back; drop just this entry
+        build_zip_from_images.clear(url, timeout_s=int(timeout_s), max_images=int(max_images))
+        st.error("The ZIP is no longer available, please fetch the images again.")
+        st.stop()
+
+    with zip_file:
+        st.download_button(
+            label="⬇️ Download ZIP now",
+            data=zip_file,
+            file_name=zip_name,
+            mime="application/zip",
+            use_container_width=True,
+        )
 
     with st.expander("See downloaded files"):
         for d in downloaded[:200]: